@@ -1,19 +1,66 @@
 import os
+import sys
 from dotenv import load_dotenv
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 import time
 import json
+import gzip
+import zlib
 import csv
 import requests
 import random
 import threading
+import signal
+from itertools import repeat
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:
+    _ENCODE = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=asdict).encode
+
+    def dumps(obj):
+        return _ENCODE(obj).encode("utf-8")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+POOL_SIZE = 32
+HOST_POOLS = 3  # openweathermap, weatherapi, logz.io
 SESSION = requests.Session()
-DEFAULT_TIMEOUT = (5, 10) 
-MAX_BATCH = 200
+SESSION.mount("https://", HTTPAdapter(pool_connections=HOST_POOLS, pool_maxsize=POOL_SIZE, pool_block=True))
+IN_FLIGHT = threading.BoundedSemaphore(POOL_SIZE)
+PAUSED_UNTIL = {}  # host -> time.monotonic() deadline after a 429
+PAUSED_LOCK = threading.Lock()
+DEFAULT_TIMEOUT = (3, 10)  # (connect, read) seconds
+MAX_BATCH = 2000  # records per Logz.io request
 MAX_RETRIES = 5
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
 BASE_BACKOFF = 0.5  # seconds
+MAX_RETRY_AFTER = 60  # seconds
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
 SHUTTING_DOWN = threading.Event()
+ZSTD_REJECTED = threading.Event()
+
+OPEN_WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather?appid={key}&units=metric&q="
+WEATHER_API_URL = "https://api.weatherapi.com/v1/current.json?key={key}&q="
+PROVIDER_MODES = ("all", "first_success")
+
+OPEN_WEATHER_PROVIDER = sys.intern("open_weather")
+WEATHER_API_PROVIDER = sys.intern("weather_api")
+CSV_PROVIDER = sys.intern("csv file")
 
 load_dotenv()
 
@@ -22,161 +69,288 @@ class Config:
     open_weather_api_key: str
     weather_api_key: str
     csv_file: str
-    source_type: str
+    source_types: list[str]
     logz_token: str
     logz_listener: str
     logz_type: str
     polling_interval: int
     cities: list[str]
+    concurrency: int
+    provider_mode: str
+    compression: str
+    open_weather_url: str
+    weather_api_url: str
 
     @staticmethod
     def load():
+        provider_mode = os.getenv("PROVIDER_MODE", "all")
+        if provider_mode not in PROVIDER_MODES:
+            raise ValueError(f"PROVIDER_MODE must be one of {', '.join(PROVIDER_MODES)}, got {provider_mode!r}")
+        open_weather_api_key = os.getenv("OPEN_WEATHER_API_KEY")
+        weather_api_key = os.getenv("WEATHER_API_KEY")
         return Config(
-            open_weather_api_key=os.getenv("OPEN_WEATHER_API_KEY"),
-            weather_api_key=os.getenv("WEATHER_API_KEY"),
+            open_weather_api_key=open_weather_api_key,
+            weather_api_key=weather_api_key,
             csv_file=os.getenv("CSV_FILE"),
-            source_type=os.getenv("SOURCE_TYPE"),
+            source_types=[s.strip() for s in os.getenv("SOURCE_TYPES", os.getenv("SOURCE_TYPE", "")).split(",")],
             logz_token=os.getenv("LOGZ_TOKEN"),
             logz_listener=os.getenv("LOGZ_LISTENER"),
             logz_type=os.getenv("LOGZ_TYPE"),
             polling_interval=int(os.getenv("POLLING_INTERVAL", "60")),
-            cities=[c.strip() for c in os.getenv("CITIES", "").split(",")]
+            cities=[c.strip() for c in os.getenv("CITIES", "").split(",")],
+            concurrency=int(os.getenv("CONCURRENCY", "20")),
+            provider_mode=provider_mode,
+            compression=os.getenv("COMPRESSION", "gzip"),
+            open_weather_url=OPEN_WEATHER_URL.format(key=open_weather_api_key),
+            weather_api_url=WEATHER_API_URL.format(key=weather_api_key),
         )
 
 
+@dataclass(slots=True)
+class WeatherRecord:
+    city: str | None
+    temperature_celsius: float | None
+    description: str | None
+    source_provider: str
+
+
 def normalize_open_weather(raw):
-    return {
-        "city": raw.get("name"),
-        "temperature_celsius": raw.get("main", {}).get("temp"),
-        "description": raw.get("weather", [{}])[0].get("description"),
-        "source_provider": "open_weather",
-    }
+    return WeatherRecord(
+        city=raw.get("name"),
+        temperature_celsius=raw.get("main", {}).get("temp"),
+        description=raw.get("weather", [{}])[0].get("description"),
+        source_provider=OPEN_WEATHER_PROVIDER,
+    )
 
 def normalize_weather_api(raw):
-    return {
-        "city": raw.get("location", {}).get("name"),
-        "temperature_celsius": raw.get("current", {}).get("temp_c"),
-        "description": raw.get("current", {}).get("condition", {}).get("text"),
-        "source_provider": "weather_api",
-    }
+    return WeatherRecord(
+        city=raw.get("location", {}).get("name"),
+        temperature_celsius=raw.get("current", {}).get("temp_c"),
+        description=raw.get("current", {}).get("condition", {}).get("text"),
+        source_provider=WEATHER_API_PROVIDER,
+    )
 
 def backoff(i, retry_after) -> float:
     if retry_after is not None:
         return retry_after
     return (BASE_BACKOFF * (2 ** i)) + random.random() * 0.5
 
-def send_to_logz_io(batch_logs, config):
-    if not batch_logs:
+def parse_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if seconds <= 0:
+        return None
+    return min(seconds, MAX_RETRY_AFTER)
+
+def pause_host(host, delay):
+    with PAUSED_LOCK:
+        PAUSED_UNTIL[host] = max(PAUSED_UNTIL.get(host, 0), time.monotonic() + delay)
+
+def wait_for_host(host):
+    with PAUSED_LOCK:
+        delay = PAUSED_UNTIL.get(host, 0) - time.monotonic()
+    if delay > 0:
+        SHUTTING_DOWN.wait(delay)
+
+class ShuttingDown(Exception):
+    pass
+
+def request_with_retry(method, url, **kwargs):
+    host = urlsplit(url).netloc
+    for i in range(MAX_RETRIES + 1):
+        wait_for_host(host)
+        if SHUTTING_DOWN.is_set():
+            raise ShuttingDown()
+        with IN_FLIGHT:
+            response = SESSION.request(method, url, timeout=DEFAULT_TIMEOUT, **kwargs)
+        if response.status_code in RETRY_STATUSES and i < MAX_RETRIES:
+            delay = backoff(i, parse_retry_after(response))
+            if response.status_code == 429:
+                pause_host(host, delay)
+            SHUTTING_DOWN.wait(delay)
+            continue
+        response.raise_for_status()
+        return response
+
+def use_zstd(config):
+    return config.compression == "zstd" and zstandard is not None and not ZSTD_REJECTED.is_set()
+
+def send_to_logz_io(body, config, encoding="gzip"):
+    if not body:
         return
     
     url = f"https://listener.logz.io:8071/{config.logz_listener}?token={config.logz_token}"
     headers = {
         "Content-Type": "application/json",
+        "Content-Encoding": encoding,
     }
-
-    i = 0
-
-    while True:
-        try:
-            response = SESSION.post(url, data=batch_logs, headers=headers, timeout=DEFAULT_TIMEOUT)
-            response.raise_for_status()
-            break
-        except requests.exceptions.RequestException as e:
-            if SHUTTING_DOWN.is_set():
-                raise
-            if e.response is not None and e.response.status_code == 429:
-                retry_after = e.response.headers.get("Retry-After")
-                if retry_after is not None:
-                    time.sleep(backoff(i, float(retry_after)))
-                i += 1
-                continue
+    try:
+        request_with_retry("POST", url, data=body, headers=headers)
+    except requests.exceptions.HTTPError as e:
+        if encoding != "zstd" or e.response.status_code != 415:
             raise
+        ZSTD_REJECTED.set()
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        send_to_logz_io(gzip.compress(raw, compresslevel=GZIP_LEVEL), config)
 
 def fetch_open_weather(city, config):
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={config.open_weather_api_key}&units=metric"
-    i = 0
-    while True:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            if SHUTTING_DOWN.is_set():
-                raise
-            if e.response is not None and e.response.status_code == 429:
-                retry_after = e.response.headers.get("Retry-After")
-                if retry_after is not None:
-                    time.sleep(backoff(i, float(retry_after)))
-                i += 1
-                continue
-            raise
+    return request_with_retry("GET", config.open_weather_url + city).json()
 
 def fetch_weather_api(city, config):
-    url = f"https://api.weatherapi.com/v1/current.json?key={config.weather_api_key}&q={city}"
-    i = 0
-    while True:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            if SHUTTING_DOWN.is_set():
-                raise
-            if e.response is not None and e.response.status_code == 429:
-                retry_after = e.response.headers.get("Retry-After")
-                if retry_after is not None:
-                    time.sleep(backoff(i, float(retry_after)))
-                i += 1
-                continue
-            raise
+    return request_with_retry("GET", config.weather_api_url + city).json()
+
+def fetch_open_weather_record(city, config):
+    return normalize_open_weather(fetch_open_weather(city, config))
+
+def fetch_weather_api_record(city, config):
+    return normalize_weather_api(fetch_weather_api(city, config))
+
+def fetch_first_success(city, config):
+    try:
+        return fetch_open_weather_record(city, config)
+    except requests.exceptions.RequestException:
+        return fetch_weather_api_record(city, config)
+
+def submit_fetches(executor, config):
+    both_providers = "OPEN_WEATHER" in config.source_types and "WEATHER_API" in config.source_types
+    if both_providers and config.provider_mode == "first_success":
+        fetchers = [fetch_first_success]
+    else:
+        fetchers = []
+        if "OPEN_WEATHER" in config.source_types:
+            fetchers.append(fetch_open_weather_record)
+        if "WEATHER_API" in config.source_types:
+            fetchers.append(fetch_weather_api_record)
+    return [executor.submit(fetch, city, config) for fetch in fetchers for city in config.cities]
+
+CSV_COLUMN_TYPES = {"city": "string", "temperature": "float64", "description": "string"}
 
 def read_csv_file(csv_file, logs):
+    if pa is None:
+        read_csv_file_stdlib(csv_file, logs)
+        return
+    if os.path.getsize(csv_file) == 0:
+        return
+    table = pacsv.read_csv(
+        csv_file,
+        read_options=pacsv.ReadOptions(encoding="latin1"),
+        convert_options=pacsv.ConvertOptions(
+            column_types=CSV_COLUMN_TYPES,
+            include_columns=list(CSV_COLUMN_TYPES),
+            null_values=[],
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    logs.extend(map(
+        WeatherRecord,
+        table["city"].to_pylist(),
+        table["temperature"].to_pylist(),
+        table["description"].to_pylist(),
+        repeat(CSV_PROVIDER),
+    ))
+
+def read_csv_file_stdlib(csv_file, logs):
     with open(csv_file, newline="", encoding="latin1") as f:
-        reader = csv.DictReader(f, delimiter=",")
-        for row in reader:
-            city = row["city"]
-            temperature_celsius = float(row["temperature"])
-            description = row["description"].strip('"')
-            source_provider = "csv file"
-            normalized_file_data = {
-                "city": city,
-                "temperature_celsius": temperature_celsius,
-                "description": description,
-                "source_provider": source_provider
-            }
-            logs.append(normalized_file_data)
+        reader = csv.reader(f, delimiter=",", quotechar='"')
+        header = next(reader, None)
+        if header is None:
+            return
+        idx = {name: i for i, name in enumerate(header)}
+        city_i, temperature_i, description_i = idx["city"], idx["temperature"], idx["description"]
+        logs.extend(
+            WeatherRecord(row[city_i], float(row[temperature_i]), row[description_i], CSV_PROVIDER)
+            for row in reader if row
+        )
 
 def to_ndjson(logs):
-    return "\n".join(json.dumps(log) for log in logs) + "\n"
+    return b"\n".join(dumps(log) for log in logs) + b"\n"
 
-def main():
-    config = Config.load()
-    count = 1
+class BatchShipper:
+    def __init__(self, config, executor, batch_size=MAX_BATCH):
+        self.config = config
+        self.executor = executor
+        self.batch_size = batch_size
+        self.futures = []
+        self._reset()
+
+    def _reset(self):
+        if use_zstd(self.config):
+            self.encoding = "zstd"
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            self.encoding = "gzip"
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self.chunks = []
+        self.count = 0
+
+    def add(self, record):
+        self.chunks.append(self.compressor.compress(dumps(record) + b"\n"))
+        self.count += 1
+        if self.count >= self.batch_size:
+            self.flush()
 
-    while True:
+    def flush(self):
+        if not self.count:
+            return
+        self.chunks.append(self.compressor.flush())
+        self.futures.append(self.executor.submit(send_to_logz_io, b"".join(self.chunks), self.config, self.encoding))
+        self._reset()
+
+    def close(self):
+        self.flush()
+        for future in self.futures:
+            future.result()
+
+def shutdown(signum, frame):
+    SHUTTING_DOWN.set()
+    SESSION.close()
+
+def poll_once(config, fetch_pool, ship_pool):
+    fetches = submit_fetches(fetch_pool, config)
+    shipper = BatchShipper(config, ship_pool)
+
+    if "FILE" in config.source_types:
         logs = []
+        read_csv_file(config.csv_file, logs)
+        for log in logs:
+            shipper.add(log)
+
+    for future in as_completed(fetches):
+        shipper.add(future.result())
 
-        if config.source_type == "FILE":
-            read_csv_file(config.csv_file, logs)
+    shipper.close()
 
-        if config.source_type == "OPEN_WEATHER":
-            for city in config.cities:
-                raw_open_weather = fetch_open_weather(city, config)
-                normalized_open_weather = normalize_open_weather(raw_open_weather)
-                logs.append(normalized_open_weather)
+def main():
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    config = Config.load()
+    count = 1
+    next_tick = time.monotonic()
 
-        if config.source_type == "WEATHER_API":
-            for city in config.cities:
-                raw_weather_api = fetch_weather_api(city, config)
-                normalized_weather_api = normalize_weather_api(raw_weather_api)
-                logs.append(normalized_weather_api)
-        
-        send_to_logz_io(to_ndjson(logs), config)
+    while not SHUTTING_DOWN.is_set():
+        next_tick = max(next_tick, time.monotonic()) + config.polling_interval
+
+        with ThreadPoolExecutor(max_workers=config.concurrency) as fetch_pool, \
+                ThreadPoolExecutor(max_workers=config.concurrency) as ship_pool:
+            try:
+                poll_once(config, fetch_pool, ship_pool)
+            except (ShuttingDown, CancelledError):
+                fetch_pool.shutdown(cancel_futures=True)
+                ship_pool.shutdown(cancel_futures=True)
+                break
 
         print("Polling", count, "sent to Logz.io successfully")
         count += 1
 
-        time.sleep(config.polling_interval)
+        SHUTTING_DOWN.wait(max(0, next_tick - time.monotonic()))
+
+    print("Shutting down")
 
 
 if __name__ == "__main__":
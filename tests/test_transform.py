@@ -1,6 +1,9 @@
-import json
+import gzip
 import pytest
-from main import normalize_open_weather, normalize_weather_api, read_csv_file, to_ndjson
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import main
+from main import WeatherRecord, normalize_open_weather, normalize_weather_api, read_csv_file, read_csv_file_stdlib, to_ndjson, BatchShipper
 
 def test_normalize_open_weather():
     raw = {
@@ -8,22 +11,22 @@ def test_normalize_open_weather():
         "main": {"temp": 18.5},
         "weather": [{"description": "Scattered clouds"}],
     }
-    expected = {
-        "city": "Berlin",
-        "temperature_celsius": 18.5,
-        "description": "Scattered clouds",
-        "source_provider": "open_weather"
-    }
+    expected = WeatherRecord(
+        city="Berlin",
+        temperature_celsius=18.5,
+        description="Scattered clouds",
+        source_provider="open_weather",
+    )
     assert normalize_open_weather(raw) == expected
 
 def test_normalize_open_weather_empty():
     raw = {}
-    expected = {
-        "city": None,
-        "temperature_celsius": None,
-        "description": None,
-        "source_provider": "open_weather"
-    }
+    expected = WeatherRecord(
+        city=None,
+        temperature_celsius=None,
+        description=None,
+        source_provider="open_weather",
+    )
     assert normalize_open_weather(raw) == expected
 
 def test_normalize_weather_api():
@@ -31,49 +34,190 @@ def test_normalize_weather_api():
         "location": {"name": "Berlin"},
         "current": {"temp_c": 18.5, "condition": {"text": "Scattered clouds"}},
     }
-    expected = {
-        "city": "Berlin",
-        "temperature_celsius": 18.5,
-        "description": "Scattered clouds",
-        "source_provider": "weather_api"
-    }
+    expected = WeatherRecord(
+        city="Berlin",
+        temperature_celsius=18.5,
+        description="Scattered clouds",
+        source_provider="weather_api",
+    )
     assert normalize_weather_api(raw) == expected
 
 def test_normalize_weather_api_empty():
     raw = {}
-    expected = {
-        "city": None,
-        "temperature_celsius": None,
-        "description": None,
-        "source_provider": "weather_api"
-    }
+    expected = WeatherRecord(
+        city=None,
+        temperature_celsius=None,
+        description=None,
+        source_provider="weather_api",
+    )
     assert normalize_weather_api(raw) == expected
 
 def test_read_csv_file():
-    expected = [{
-        "city": "Berlin",
-        "temperature_celsius": 18.5,
-        "description": "Scattered clouds",
-        "source_provider": "csv file"
-    }, {
-        "city": "Sydney",
-        "temperature_celsius": 22.1,
-        "description": "Sunny",
-        "source_provider": "csv file"
-    }]
+    expected = [WeatherRecord(
+        city="Berlin",
+        temperature_celsius=18.5,
+        description="Scattered clouds",
+        source_provider="csv file",
+    ), WeatherRecord(
+        city="Sydney",
+        temperature_celsius=22.1,
+        description="Sunny",
+        source_provider="csv file",
+    )]
     logs = []
     read_csv_file("weather.csv", logs)
     assert logs == expected
 
+    logs = []
+    read_csv_file_stdlib("weather.csv", logs)
+    assert logs == expected
+
+@pytest.mark.parametrize("reader", [read_csv_file, read_csv_file_stdlib])
+def test_read_csv_file_empty(tmp_path, reader):
+    csv_file = tmp_path / "empty.csv"
+    csv_file.write_text("")
+    logs = []
+    reader(str(csv_file), logs)
+    assert logs == []
+
+@pytest.mark.parametrize("reader", [read_csv_file, read_csv_file_stdlib])
+def test_read_csv_file_missing_temperature(tmp_path, reader):
+    csv_file = tmp_path / "missing.csv"
+    csv_file.write_text("city,temperature,description\nBerlin,,Sunny\n")
+    with pytest.raises(ValueError):
+        reader(str(csv_file), [])
+
 def test_to_ndjson():
-    logs = [{
-        "city": "Berlin",
-        "temperature_celsius": 18.5,
-        "description": "Scattered clouds",
-        "source_provider": "csv file"
-    }]
-    assert to_ndjson(logs) == "{\"city\": \"Berlin\", \"temperature_celsius\": 18.5, \"description\": \"Scattered clouds\", \"source_provider\": \"csv file\"}\n"
+    logs = [WeatherRecord(
+        city="Berlin",
+        temperature_celsius=18.5,
+        description="Scattered clouds",
+        source_provider="csv file",
+    )]
+    assert to_ndjson(logs) == b"{\"city\":\"Berlin\",\"temperature_celsius\":18.5,\"description\":\"Scattered clouds\",\"source_provider\":\"csv file\"}\n"
+
+def test_batch_shipper(monkeypatch):
+    bodies = []
+    monkeypatch.setattr(main, "send_to_logz_io", lambda body, config, encoding: bodies.append(body))
+    logs = [WeatherRecord(
+        city=f"City{i}",
+        temperature_celsius=float(i),
+        description="Sunny",
+        source_provider="csv file",
+    ) for i in range(5)]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        shipper = BatchShipper(SimpleNamespace(compression="gzip"), executor, batch_size=2)
+        for log in logs:
+            shipper.add(log)
+        shipper.close()
+    assert [gzip.decompress(body) for body in bodies] == [to_ndjson(logs[0:2]), to_ndjson(logs[2:4]), to_ndjson(logs[4:])]
+
+def test_batch_shipper_zstd(monkeypatch):
+    zstandard = pytest.importorskip("zstandard")
+    sent = []
+    monkeypatch.setattr(main, "send_to_logz_io", lambda body, config, encoding: sent.append((body, encoding)))
+    logs = [WeatherRecord(
+        city="Berlin",
+        temperature_celsius=18.5,
+        description="Scattered clouds",
+        source_provider="csv file",
+    )]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        shipper = BatchShipper(SimpleNamespace(compression="zstd"), executor)
+        shipper.add(logs[0])
+        shipper.close()
+    [(body, encoding)] = sent
+    assert encoding == "zstd"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(body) == to_ndjson(logs)
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise main.requests.exceptions.HTTPError(response=self)
+
+@pytest.fixture
+def no_wait(monkeypatch):
+    delays = []
+    monkeypatch.setattr(main.SHUTTING_DOWN, "wait", lambda timeout=None: delays.append(timeout))
+    monkeypatch.setattr(main, "PAUSED_UNTIL", {})
+    return delays
+
+def stub_responses(monkeypatch, responses):
+    calls = []
+    def request(method, url, **kwargs):
+        calls.append(url)
+        return responses[len(calls) - 1]
+    monkeypatch.setattr(main.SESSION, "request", request)
+    return calls
+
+@pytest.mark.parametrize("status", [408, 429, 500, 502, 503, 504])
+def test_request_with_retry_retries_transient_statuses(monkeypatch, no_wait, status):
+    calls = stub_responses(monkeypatch, [FakeResponse(status), FakeResponse(200)])
+    assert main.request_with_retry("GET", "https://example.com/x").status_code == 200
+    assert len(calls) == 2
+
+def test_request_with_retry_gives_up_after_max_retries(monkeypatch, no_wait):
+    calls = stub_responses(monkeypatch, [FakeResponse(503)] * (main.MAX_RETRIES + 1))
+    with pytest.raises(main.requests.exceptions.HTTPError):
+        main.request_with_retry("GET", "https://example.com/x")
+    assert len(calls) == main.MAX_RETRIES + 1
+
+def test_request_with_retry_does_not_retry_other_4xx(monkeypatch, no_wait):
+    calls = stub_responses(monkeypatch, [FakeResponse(404)])
+    with pytest.raises(main.requests.exceptions.HTTPError):
+        main.request_with_retry("GET", "https://example.com/x")
+    assert len(calls) == 1
 
+@pytest.mark.parametrize("value, expected", [
+    ("2", 2.0),
+    ("0", None),
+    ("-1", None),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", None),
+    ("3600", main.MAX_RETRY_AFTER),
+])
+def test_parse_retry_after(value, expected):
+    assert main.parse_retry_after(FakeResponse(429, {"Retry-After": value})) == expected
 
+def test_config_rejects_unknown_provider_mode(monkeypatch):
+    monkeypatch.setenv("PROVIDER_MODE", "first-success")
+    with pytest.raises(ValueError):
+        main.Config.load()
 
+def test_first_success_falls_back_to_weather_api(monkeypatch):
+    calls = []
+    def request_with_retry(method, url, **kwargs):
+        calls.append(url)
+        if url.startswith("ow:"):
+            raise main.requests.exceptions.HTTPError(response=FakeResponse(503))
+        response = FakeResponse(200)
+        response.json = lambda: {"location": {"name": url[len("wa:"):]}}
+        return response
+    monkeypatch.setattr(main, "request_with_retry", request_with_retry)
+    config = SimpleNamespace(
+        source_types=["OPEN_WEATHER", "WEATHER_API"],
+        provider_mode="first_success",
+        cities=["Berlin", "Sydney"],
+        open_weather_url="ow:",
+        weather_api_url="wa:",
+    )
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        records = [future.result() for future in main.submit_fetches(executor, config)]
+    assert [(r.city, r.source_provider) for r in records] == [("Berlin", "weather_api"), ("Sydney", "weather_api")]
+    assert calls == ["ow:Berlin", "wa:Berlin", "ow:Sydney", "wa:Sydney"]
 
+def test_request_with_retry_stops_when_shutting_down(monkeypatch, no_wait):
+    calls = stub_responses(monkeypatch, [FakeResponse(503), FakeResponse(200)])
+    monkeypatch.setattr(main.SHUTTING_DOWN, "wait", lambda timeout=None: main.SHUTTING_DOWN.set())
+    try:
+        with pytest.raises(main.ShuttingDown):
+            main.request_with_retry("GET", "https://example.com/x")
+        assert len(calls) == 1
+        with pytest.raises(main.ShuttingDown):
+            main.request_with_retry("GET", "https://example.com/x")
+        assert len(calls) == 1
+    finally:
+        main.SHUTTING_DOWN.clear()